@@ -1,24 +1,60 @@
-import json
+import asyncio
+import logging
 import os
 import tempfile
-import uuid
+import time
+from contextlib import asynccontextmanager
 from enum import Enum
-from typing import Literal
+from functools import partial
+from itertools import count
+from typing import IO, AsyncIterator, Literal
+from urllib.parse import unquote
 
+from blake3 import blake3
+from cachetools import TTLCache
 from dotenv import load_dotenv
 from emergentintegrations.llm.chat import FileContentWithMimeType, ImageContent, LlmChat, UserMessage
-from fastapi import FastAPI, File, Form, HTTPException, UploadFile
+from fastapi import FastAPI, File, Form, Header, HTTPException, Request, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field, ValidationError, field_validator
 
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 EMERGENT_LLM_KEY = os.getenv("EMERGENT_LLM_KEY")
 if not EMERGENT_LLM_KEY:
     raise RuntimeError("EMERGENT_LLM_KEY is not set. Please configure it in backend/.env or environment.")
 
 GEMINI_MODEL_NAVIGATION = "gemini-2.5-pro"
+NAVIGATION_WARMUP_CALL = os.getenv("NAVIGATION_WARMUP_CALL", "").lower() in {"1", "true", "yes"}
+
+# Upper bound on "data:<mime>;base64," headers; keeps the comma search off the payload.
+_DATA_URL_HEADER_MAX_LEN = 128
+
+# Largest screenshot accepted on any navigation endpoint, and the matching encoded
+# length (plus room for an optional data URL header).
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+MAX_IMAGE_BASE64_LEN = 4 * ((MAX_IMAGE_BYTES + 2) // 3) + _DATA_URL_HEADER_MAX_LEN
+_IMAGE_TOO_LARGE_DETAIL = f"Screenshot exceeds {MAX_IMAGE_BYTES} bytes."
+
+# Read size used when copying uploads to disk.
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Directory for staged uploads (None = system default). Set UPLOAD_TMP_DIR=/dev/shm
+# to keep them in RAM; each file lives for a whole Gemini round-trip, so size the
+# tmpfs for MAX_IMAGE_BYTES times the expected concurrency.
+UPLOAD_TMP_DIR = os.getenv("UPLOAD_TMP_DIR") or None
+
+_ALLOWED_MIMES = frozenset({"image/png", "image/jpeg", "image/webp"})
+
+# Exact-match cache of validated actions keyed by (screenshot hash, goal, session id, context).
+ACTION_CACHE_MAXSIZE = 4096
+ACTION_CACHE_TTL_SECONDS = 300
+_ACTION_CACHE: TTLCache = TTLCache(maxsize=ACTION_CACHE_MAXSIZE, ttl=ACTION_CACHE_TTL_SECONDS)
+# Gemini calls currently running, keyed like _ACTION_CACHE.
+_INFLIGHT_ACTIONS: dict[tuple, asyncio.Task] = {}
 
 
 class ActionEnum(str, Enum):
@@ -79,8 +115,22 @@ class NavigateBase64Request(BaseModel):
         return v
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Optionally send one tiny prompt at startup (NAVIGATION_WARMUP_CALL=1).
+
+    The call sets up the provider connection before traffic arrives, so the
+    first navigation request does not pay for it. It is billed, hence opt-in.
+    """
+    if NAVIGATION_WARMUP_CALL:
+        try:
+            await build_chat().send_message(UserMessage(text="Reply with an empty JSON object."))
+        except Exception:
+            logger.warning("LLM warm-up call failed; continuing without it.", exc_info=True)
+    yield
 
-app = FastAPI(title="UI Navigation Agent")
+
+app = FastAPI(title="UI Navigation Agent", default_response_class=ORJSONResponse, lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -91,6 +141,10 @@ app.add_middleware(
 )
 
 
+# Keep the prompt a fixed, byte-identical prefix of every request: Gemini's
+# implicit context caching only reuses prefixes that match exactly. The Emergent
+# SDK does not expose explicit cached_content handles, so this is the prompt
+# cache we get.
 SYSTEM_PROMPT = """
 You are a UI Navigation Agent. Your goal is to execute user intents by observing screenshots and outputting precise JSON actions.
 
@@ -167,12 +221,6 @@ You MUST output ONLY a single JSON object with this exact schema and nothing els
 }
 
 
-@app.get("/api/health")
-async def health() -> dict:
-    """Simple health check endpoint for frontend connectivity tests."""
-    return {"status": "ok", "provider": "gemini", "model": GEMINI_MODEL_NAVIGATION}
-
-
 Rules:
 - Never include any explanatory text, markdown, backticks, or comments outside of the JSON.
 - Do not wrap the JSON in code fences.
@@ -185,17 +233,66 @@ Rules:
 """.strip()
 
 
+@app.get("/api/health")
+async def health() -> dict:
+    """Simple health check endpoint for frontend connectivity tests."""
+    return {"status": "ok", "provider": "gemini", "model": GEMINI_MODEL_NAVIGATION}
+
+
+# LlmChat keeps per-instance message history, so a single instance cannot be
+# shared across requests. Bind the constant arguments once and only create the
+# thin per-request wrapper in build_chat().
+_new_chat = partial(LlmChat, api_key=EMERGENT_LLM_KEY, system_message=SYSTEM_PROMPT)
+
+
+# Chat session ids are only correlation tags, so a per-process counter is
+# enough; the start time and pid keep them distinct across workers and restarts.
+_SESSION_PREFIX = f"nav-{time.time_ns():x}-{os.getpid()}"
+_session_counter = count()
+
+
 def build_chat() -> LlmChat:
-    session_id = f"nav-{uuid.uuid4()}"
-    chat = LlmChat(
-        api_key=EMERGENT_LLM_KEY,
-        session_id=session_id,
-        system_message=SYSTEM_PROMPT,
-    ).with_model("gemini", GEMINI_MODEL_NAVIGATION)
-    return chat
+    session_id = f"{_SESSION_PREFIX}-{next(_session_counter):x}"
+    return _new_chat(session_id=session_id).with_model("gemini", GEMINI_MODEL_NAVIGATION)
+
 
+def _parse_action(response_text: object) -> dict:
+    """Validate the model reply as a NavigationAction and return it as a plain dict."""
+    if not isinstance(response_text, str):
+        response_text = str(response_text)
+    # Drop optional ```json ... ``` fences; each call is a no-op when absent.
+    # Only the 4-character language tag is lowercased, never the whole reply.
+    raw = response_text.strip().removeprefix("```")
+    if raw[:4].lower() == "json":
+        raw = raw[4:]
+    raw = raw.removesuffix("```").strip()
 
-async def call_navigation_agent(image_path: str, mime_type: str, goal: str, session_id: str | None = None, context: str | None = None) -> NavigationAction:
+    try:
+        # Parse and validate in one pass inside pydantic-core; malformed JSON
+        # is reported as a ValidationError too.
+        action = NavigationAction.model_validate_json(raw)
+    except ValidationError as exc:
+        raise HTTPException(
+            status_code=500,
+            detail={
+                "error": "LLM response invalid",
+                "message": str(exc),
+            },
+        ) from exc
+    return action.model_dump()
+
+
+def _render_user_text(goal: str, session_id: str | None, context: str | None) -> str:
+    """Build the user instruction, including optional session and context for better reasoning."""
+    return (
+        f"User Goal: {goal.strip()}\n"
+        + (f"Session ID: {session_id}\n" if session_id else "")
+        + (f"Context: {context}\n" if context else "")
+        + "Remember: respond with ONLY the JSON object, nothing else."
+    )
+
+
+async def call_navigation_agent(image_path: str, mime_type: str, goal: str, session_id: str | None = None, context: str | None = None) -> dict:
     chat = build_chat()
 
     file_content = FileContentWithMimeType(
@@ -203,66 +300,92 @@ async def call_navigation_agent(image_path: str, mime_type: str, goal: str, sess
         mime_type=mime_type,
     )
 
-    # Build rich user instruction including optional session and context for better reasoning
-    parts = [f"User Goal: {goal.strip()}"]
-    if session_id:
-        parts.append(f"Session ID: {session_id}")
-    if context:
-        parts.append(f"Context: {context}")
+    user_text = _render_user_text(goal, session_id, context)
 
-    parts.append("Remember: respond with ONLY the JSON object, nothing else.")
+    response_text = await chat.send_message(
+        UserMessage(text=user_text, file_contents=[file_content])
+    )
 
+    return _parse_action(response_text)
 
-async def call_navigation_agent_base64(
-    image_base64: str,
-    mime_type: str | None,
+
+async def _request_action_base64(
+    base64_str: str,
     goal: str,
-    session_id: str | None = None,
-    context: str | None = None,
-) -> NavigationAction:
+    session_id: str | None,
+    context: str | None,
+) -> dict:
     chat = build_chat()
-
-    # Support optional data URL prefix, but prefer raw base64 for performance
-    base64_str = image_base64.strip()
-    if base64_str.startswith("data:") and "," in base64_str:
-        base64_str = base64_str.split(",", 1)[1]
-
     image_content = ImageContent(image_base64=base64_str)
 
-    parts = [f"User Goal: {goal.strip()}"]
-    if session_id:
-        parts.append(f"Session ID: {session_id}")
-    if context:
-        parts.append(f"Context: {context}")
-
-    parts.append("Remember: respond with ONLY the JSON object, nothing else.")
-    user_text = "\n".join(parts)
+    user_text = _render_user_text(goal, session_id, context)
 
     response_text = await chat.send_message(
         UserMessage(text=user_text, file_contents=[image_content])
     )
 
-    try:
-        if isinstance(response_text, str):
-            raw = response_text.strip()
-        else:
-            raw = str(response_text).strip()
+    return _parse_action(response_text)
 
-        if raw.startswith("```"):
 
+def _finish_inflight(cache_key: tuple, task: asyncio.Task) -> None:
+    _INFLIGHT_ACTIONS.pop(cache_key, None)
+    # Calling exception() also marks a failure as retrieved when every waiter
+    # has gone away.
+    if not task.cancelled() and task.exception() is None:
+        _ACTION_CACHE[cache_key] = task.result()
 
-@app.post("/api/navigate/base64", response_model=NavigationAction)
-async def navigate_base64(payload: NavigateBase64Request) -> NavigationAction:
+
+async def call_navigation_agent_base64(
+    image_base64: str,
+    mime_type: str | None,
+    goal: str,
+    session_id: str | None = None,
+    context: str | None = None,
+) -> dict:
+    # Support optional data URL prefix, but prefer raw base64 for performance.
+    # Only the short header is searched for the comma, and the payload is
+    # sliced once instead of split into a list.
+    base64_str = image_base64.strip()
+    if base64_str.startswith("data:"):
+        comma = base64_str.find(",", 0, _DATA_URL_HEADER_MAX_LEN)
+        if comma != -1:
+            base64_str = base64_str[comma + 1 :]
+
+    # Retries and parallel runners often resend the exact same step; answer
+    # those from the cache instead of another Gemini round-trip. The key holds
+    # everything _render_user_text sends, so only identical prompts share a reply.
+    cache_key = (blake3(base64_str.encode()).digest(), goal.strip(), session_id, context)
+    cached = _ACTION_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+
+    # Identical requests arriving while one is still waiting on Gemini join
+    # that call instead of starting their own. The shared task is shielded so a
+    # disconnecting client does not cancel it for the others.
+    task = _INFLIGHT_ACTIONS.get(cache_key)
+    if task is None:
+        task = asyncio.create_task(_request_action_base64(base64_str, goal, session_id, context))
+        _INFLIGHT_ACTIONS[cache_key] = task
+        task.add_done_callback(partial(_finish_inflight, cache_key))
+    return await asyncio.shield(task)
+
+
+# The agent output is validated against NavigationAction before it leaves
+# call_navigation_agent*, so the routes skip FastAPI's response_model
+# re-validation and only reference the model for the OpenAPI schema.
+@app.post("/api/navigate/base64", response_model=None, responses={200: {"model": NavigationAction}})
+async def navigate_base64(payload: NavigateBase64Request) -> ORJSONResponse:
     """Navigate using a base64-encoded image and JSON payload.
 
     This is optimized for automated UI-testing loops that prefer JSON-only IO.
     """
+    # Oversize payloads get the same 413 as the other upload routes. len() is
+    # O(1), so this runs before any prefix handling, hashing or copying.
+    if len(payload.image_base64) > MAX_IMAGE_BASE64_LEN:
+        raise HTTPException(status_code=413, detail=_IMAGE_TOO_LARGE_DETAIL)
+
     # Validate MIME type if provided (must match our supported formats)
-    if payload.mime_type is not None and payload.mime_type not in {
-        "image/png",
-        "image/jpeg",
-        "image/webp",
-    }:
+    if payload.mime_type is not None and payload.mime_type not in _ALLOWED_MIMES:
         raise HTTPException(
             status_code=400,
             detail="Unsupported image MIME type. Use image/png, image/jpeg, or image/webp.",
@@ -275,90 +398,97 @@ async def navigate_base64(payload: NavigateBase64Request) -> NavigationAction:
         session_id=payload.session_id,
         context=payload.context,
     )
-    return action
+    return ORJSONResponse(action)
 
-            raw = raw.strip("`")
-            if raw.lower().startswith("json"):
-                raw = raw[4:].strip()
 
-        data = json.loads(raw)
-        action = NavigationAction.model_validate(data)
-        return action
-    except (json.JSONDecodeError, ValidationError) as exc:
-        raise HTTPException(
-            status_code=500,
-            detail={
-                "error": "LLM response invalid",
-                "message": str(exc),
-            },
-        ) from exc
+_EXT_TO_MIME = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".webp": "image/webp",
+}
 
-    user_text = "\n".join(parts)
 
-    response_text = await chat.send_message(
-        UserMessage(text=user_text, file_contents=[file_content])
-    )
+def detect_mime_type(filename: str) -> str:
+    mime_type = _EXT_TO_MIME.get(os.path.splitext(filename)[1].lower())
+    if mime_type is None:
+        raise HTTPException(status_code=400, detail="Unsupported image format. Use PNG, JPG, or WEBP.")
+    return mime_type
 
-    try:
-        if isinstance(response_text, str):
-            raw = response_text.strip()
-        else:
-            raw = str(response_text).strip()
-
-        if raw.startswith("```"):
-            raw = raw.strip("`")
-            if raw.lower().startswith("json"):
-                raw = raw[4:].strip()
-
-        data = json.loads(raw)
-        action = NavigationAction.model_validate(data)
-        return action
-    except (json.JSONDecodeError, ValidationError) as exc:
-        raise HTTPException(
-            status_code=500,
-            detail={
-                "error": "LLM response invalid",
-                "message": str(exc),
-            },
-        ) from exc
 
+async def _iter_upload(upload: UploadFile) -> AsyncIterator[bytes]:
+    while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+        yield chunk
 
-def detect_mime_type(filename: str) -> str:
-    lower = filename.lower()
-    if lower.endswith(".png"):
-        return "image/png"
-    if lower.endswith(".jpg") or lower.endswith(".jpeg"):
-        return "image/jpeg"
-    if lower.endswith(".webp"):
-        return "image/webp"
-    raise HTTPException(status_code=400, detail="Unsupported image format. Use PNG, JPG, or WEBP.")
+
+async def _write_upload(tmp: IO[bytes], chunks: AsyncIterator[bytes]) -> None:
+    """Copy screenshot chunks into tmp, rejecting empty and oversize uploads."""
+    # Bounded chunks mean a large screenshot is never held in memory whole.
+    size = 0
+    async for chunk in chunks:
+        size += len(chunk)
+        if size > MAX_IMAGE_BYTES:
+            raise HTTPException(status_code=413, detail=_IMAGE_TOO_LARGE_DETAIL)
+        tmp.write(chunk)
+    if not size:
+        raise HTTPException(status_code=400, detail="Uploaded screenshot is empty.")
+    tmp.flush()
 
 
-@app.post("/api/navigate", response_model=NavigationAction)
+@app.post("/api/navigate", response_model=None, responses={200: {"model": NavigationAction}})
 async def navigate(
     screenshot: UploadFile = File(..., description="Screenshot image of the UI"),
     goal: str = Form(..., description="User's navigation goal for this step"),
     session_id: str | None = Form(None, description="Optional session identifier for the agent loop"),
     context: str | None = Form(None, description="Optional serialized context or history for better reasoning"),
-):
+) -> ORJSONResponse:
     if not goal or not goal.strip():
         raise HTTPException(status_code=400, detail="Goal must be a non-empty string.")
 
     mime_type = detect_mime_type(screenshot.filename)
 
-    try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(screenshot.filename)[1]) as tmp:
-            content = await screenshot.read()
-            if not content:
-                raise HTTPException(status_code=400, detail="Uploaded screenshot is empty.")
-            tmp.write(content)
-            tmp_path = tmp.name
-
-        action = await call_navigation_agent(tmp_path, mime_type, goal, session_id=session_id, context=context)
-        return action
-    finally:
-        try:
-            if "tmp_path" in locals() and os.path.exists(tmp_path):
-                os.remove(tmp_path)
-        except Exception:
-            pass
+    # FileContentWithMimeType only accepts a path, so the upload goes to a temp
+    # file that is removed when the block exits.
+    with tempfile.NamedTemporaryFile(dir=UPLOAD_TMP_DIR, suffix=os.path.splitext(screenshot.filename)[1]) as tmp:
+        await _write_upload(tmp, _iter_upload(screenshot))
+
+        action = await call_navigation_agent(tmp.name, mime_type, goal, session_id=session_id, context=context)
+    return ORJSONResponse(action)
+
+
+@app.post(
+    "/api/navigate/binary",
+    response_model=None,
+    responses={200: {"model": NavigationAction}},
+    openapi_extra={"requestBody": {"content": {"application/octet-stream": {"schema": {"type": "string", "format": "binary"}}}}},
+)
+async def navigate_binary(
+    request: Request,
+    mime_type: str = Header(..., alias="X-Image-Mime", description="Screenshot MIME type: image/png, image/jpeg, or image/webp"),
+    goal: str = Header(..., alias="X-Goal", description="Percent-encoded (UTF-8) navigation goal for this step"),
+    session_id: str | None = Header(None, alias="X-Session-Id", description="Optional percent-encoded session identifier"),
+    context: str | None = Header(None, alias="X-Context", description="Optional percent-encoded serialized context or history"),
+) -> ORJSONResponse:
+    """Navigate using the raw screenshot bytes as an application/octet-stream body.
+
+    Avoids the base64 envelope of /api/navigate/base64. Step metadata travels in
+    headers rather than the URL, so it stays out of access logs: X-Image-Mime is
+    plain, while X-Goal, X-Session-Id and X-Context must be percent-encoded UTF-8
+    (e.g. urllib.parse.quote / encodeURIComponent) and are decoded here.
+    """
+    goal = unquote(goal)
+    session_id = unquote(session_id) if session_id is not None else None
+    context = unquote(context) if context is not None else None
+    if not goal.strip():
+        raise HTTPException(status_code=400, detail="Goal must be a non-empty string.")
+    if mime_type not in _ALLOWED_MIMES:
+        raise HTTPException(
+            status_code=400,
+            detail="Unsupported image MIME type. Use image/png, image/jpeg, or image/webp.",
+        )
+
+    with tempfile.NamedTemporaryFile(dir=UPLOAD_TMP_DIR) as tmp:
+        await _write_upload(tmp, request.stream())
+
+        action = await call_navigation_agent(tmp.name, mime_type, goal, session_id=session_id, context=context)
+    return ORJSONResponse(action)